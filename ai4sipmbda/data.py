@@ -6,7 +6,7 @@ import numpy as np
 import pandas as pd
 import torch
 from torch.utils.data import Dataset
-from ai4sipmbda.utils import fetching, difumo_utils
+from ai4sipmbda.utils import fetching, difumo_utils, projection_cache
 import torchio as tio
 import os
 
@@ -20,7 +20,8 @@ class NeuroData(Dataset):
         label: str = None,
         augmentation_transformations: Optional[Callable] = None,
         eval_mode: bool = False,
-        difumo_matrices_path: str = None
+        difumo_matrices_path: str = None,
+        cache_dir: str = None
     ):
 
         self.all_transformations = all_transformations
@@ -32,7 +33,15 @@ class NeuroData(Dataset):
         self.difumo_matrices_path =  difumo_matrices_path
 
         self.mask = np.load(os.path.join(self.difumo_matrices_path, "mask.npy"))
-        self.pseudo_inv_Z = np.load(os.path.join(self.difumo_matrices_path, "Zinv.npy"))
+        # Flat positions of the mask voxels, gathered directly at projection
+        self.mask_idx = np.flatnonzero(self.mask)
+        # DiFuMo vectors are stored in single precision
+        self.pseudo_inv_Z = np.load(os.path.join(self.difumo_matrices_path, "Zinv.npy")).astype(np.float32, copy=False)
+
+        # Projections of non-augmented images are cached on disk
+        self.cache_dir = cache_dir
+        if self.cache_dir is not None:
+            self.projector_hash = projection_cache.hash_arrays(self.mask, self.pseudo_inv_Z)
 
     def __len__(self) -> int:
         return len(self.df)
@@ -40,11 +49,13 @@ class NeuroData(Dataset):
     def __getitem__(self, idx):
         # import nibabel as nib
         participant, image_path, label = self._get_meta_data(idx)
-        image_tio = tio.ScalarImage(image_path)
         if not self.eval_mode and self.augmentation_transformations is not None:
-            image_tio = self.augmentation_transformations(image_tio)
-
-        difumo_proj = self.pseudo_inv_Z.dot(image_tio.data.squeeze().numpy()[self.mask])
+            difumo_proj = self._project(image_path, augment=True)
+        elif self.cache_dir is not None:
+            difumo_proj = projection_cache.load_or_project(
+                image_path, self.cache_dir, self.projector_hash, self._project)
+        else:
+            difumo_proj = self._project(image_path)
         # difumo_proj = self.all_transformations(difumo_proj)
 
         sample = {
@@ -56,6 +67,21 @@ class NeuroData(Dataset):
 
         return sample
 
+    def _project(self, image_path, augment=False):
+        image_tio = tio.ScalarImage(image_path)
+        if augment:
+            image_tio = self.augmentation_transformations(image_tio)
+
+        # The flat gather below only reads the right voxels if the image
+        # is a single volume with the same grid as the mask
+        if image_tio.num_channels != 1:
+            raise ValueError(f"Expected a single channel image, got {image_tio.num_channels} channels for {image_path}")
+        if tuple(image_tio.spatial_shape) != self.mask.shape:
+            raise ValueError(f"Image shape {tuple(image_tio.spatial_shape)} does not match mask shape {self.mask.shape} for {image_path}")
+
+        voxels = np.take(image_tio.data.numpy().ravel(), self.mask_idx)
+        return self.pseudo_inv_Z.dot(voxels).astype(np.float32, copy=False)
+
     def _get_meta_data(self, idx: int) -> Tuple[str, str, int]:
         """
         Gets all meta data necessary to compute the path with _get_image_path
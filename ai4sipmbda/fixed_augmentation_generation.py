@@ -1,4 +1,9 @@
+import os
+from itertools import cycle, islice
+
+import numpy as np
 import pandas as pd
+from joblib import Parallel, delayed
 
 from ai4sipmbda.transforms import get_transforms
 from ai4sipmbda.utils.fetching import get_dataset_labels, filter_subjects_with_all_tasks
@@ -7,22 +12,16 @@ import pandas as pd
 from typing import List
 from tqdm import tqdm
 
-def get_row(NeuroDataItem):
-    difumo_cols = [f"difumo_{i}" for i in range(len(NeuroDataItem["difumo_vector"]))]
-    meta_cols = ["subject_id", "label","image_path"]
-    all_cols = meta_cols +difumo_cols
-    concatenated_vector  = list([*[NeuroDataItem[key] for key in meta_cols], *NeuroDataItem["difumo_vector"]])
-    difumo_vector_pd = pd.DataFrame.from_records([concatenated_vector], columns = all_cols)
-
-    return difumo_vector_pd
-
 def project_difumo(
         df,
         difumo_matrices_path:str,
         prior_augmentation: bool = False,
         augmentation_name: List [str] = None,
         num_generated_samples: int = None,
-        save_path: str  = None
+        save_path: str  = None,
+        n_jobs: int = 1,
+        cache_dir: str = None,
+        chunk_size: int = 1000
             ):
     if num_generated_samples is None:
         num_generated_samples = df.shape[0]
@@ -34,43 +33,62 @@ def project_difumo(
     NeuroData_obj = NeuroData(data_df=df, all_transformations=all_transforms,
                               augmentation_transformations=augmentation_transforms,
                               label="contrast",
-                              difumo_matrices_path=difumo_matrices_path, eval_mode=False)
-
-    projected_df = pd.DataFrame()
-
-    generated_ind= 0
-    while generated_ind<num_generated_samples:
-        print(f"Iterating over the dataset until we reach the desired number of samples, {num_generated_samples - generated_ind} samples left")
-        num_samples_from_df = max((num_generated_samples - generated_ind)%df.shape[0], num_generated_samples)
-        for ind, _ in tqdm(df.loc[:num_samples_from_df].iterrows()):
-            if generated_ind>=num_generated_samples:
-                break
+                              difumo_matrices_path=difumo_matrices_path, eval_mode=False,
+                              cache_dir=cache_dir)
 
-            row = get_row(NeuroData_obj.__getitem__(ind))
-            projected_df = pd.concat([projected_df, row], ignore_index=True)
-            generated_ind+=1
+    # Iterating over the dataset until we reach the desired number of samples
+    indices = list(islice(cycle(df.index), num_generated_samples))
 
     augmentation_name_str = '-'.join(augmentation_name) if isinstance(augmentation_name, list) else augmentation_name
-    projected_df["augmentation"] = augmentation_name_str
+    output_path = os.path.join(save_path,  f"difumo-augm_{augmentation_name_str}")
     os.makedirs(save_path, exist_ok=True)
 
-    projected_df.to_csv(os.path.join(save_path,  f"difumo-augm_{augmentation_name_str}.csv"))
-
-
-def execute_projections(base_dataset_path:str , difumo_maps_path:str, save_path:str, num_samples: int):
+    # Samples are written to a memory mapped .npy file as they are produced,
+    # and released right after, so that the projections never have to fit
+    # in memory
+    n_components = NeuroData_obj.pseudo_inv_Z.shape[0]
+    difumo_vectors = np.lib.format.open_memmap(output_path + ".npy", mode="w+", dtype=np.float32,
+                                               shape=(len(indices), n_components))
+    meta_cols = ["subject_id", "label", "image_path"]
+
+    def project_one(i, ind):
+        sample = NeuroData_obj[ind]
+        difumo_vectors[i] = sample["difumo_vector"]
+        return [sample[col] for col in meta_cols]
+
+    # Images are loaded and projected by n_jobs threads: nibabel decompression
+    # and the projection release the GIL, and threads share the projector
+    # instead of pickling it to worker processes
+    meta = Parallel(n_jobs=n_jobs, prefer="threads", batch_size=8)(
+        delayed(project_one)(i, ind) for i, ind in enumerate(tqdm(indices)))
+    difumo_vectors.flush()
+
+    # The csv file is written by chunks of rows read back from the .npy file
+    meta = pd.DataFrame(meta, columns=meta_cols)
+    difumo_cols = [f"difumo_{i}" for i in range(n_components)]
+    for start in range(0, len(indices), chunk_size):
+        stop = min(start + chunk_size, len(indices))
+        projected_df = pd.concat([meta.iloc[start:stop],
+                                  pd.DataFrame(difumo_vectors[start:stop], columns=difumo_cols,
+                                               index=range(start, stop))], axis=1)
+        projected_df["augmentation"] = augmentation_name_str
+        projected_df.to_csv(output_path + ".csv", mode="w" if start == 0 else "a", header=start == 0)
+
+
+def execute_projections(base_dataset_path:str , difumo_maps_path:str, save_path:str, num_samples: int, n_jobs: int = 1, cache_dir: str = None):
 
     labels_pd = get_dataset_labels(
         base_path=base_dataset_path)
     # filtered_pd = labels_pd
     # filtered_pd = filter_subjects_with_all_tasks(labels_pd)
 
-    project_difumo(labels_pd, difumo_matrices_path=difumo_maps_path,  save_path=save_path, num_generated_samples=num_samples)
+    project_difumo(labels_pd, difumo_matrices_path=difumo_maps_path,  save_path=save_path, num_generated_samples=num_samples, n_jobs=n_jobs, cache_dir=cache_dir)
 
     augmentation_list = ["RandomElasticDeformation", "RandomMotion",  "RandomGhosting",
                          "RandomSpike",  "RandomBiasField",   "RandomBlur",  "RandomNoise",  "RandomGamma",   "RandomFlip"]
 
     for augm in augmentation_list:
-        project_difumo(labels_pd, prior_augmentation=True, num_generated_samples=num_samples, augmentation_name=[augm], difumo_matrices_path=difumo_maps_path,  save_path=save_path)
+        project_difumo(labels_pd, prior_augmentation=True, num_generated_samples=num_samples, augmentation_name=[augm], difumo_matrices_path=difumo_maps_path,  save_path=save_path, n_jobs=n_jobs)
 
 
 
@@ -91,10 +109,18 @@ if __name__=="__main__":
     parser.add_argument('--num_samples', type=int, default = None,
                         help='How many samples to generated for augmented samples')
 
+    parser.add_argument('--n_jobs', type=int, default = 1,
+                        help='Number of threads loading and projecting images')
+
+    parser.add_argument('--cache_dir', type=str, default = None,
+                        help='path where to cache projections of non-augmented images')
+
     args = parser.parse_args()
 
     execute_projections(base_dataset_path = args.base_dataset_path,
                         difumo_maps_path = args.difumo_maps_path,
                         save_path = args.save_path,
-                        num_samples = args.num_samples)
+                        num_samples = args.num_samples,
+                        n_jobs = args.n_jobs,
+                        cache_dir = args.cache_dir)
 
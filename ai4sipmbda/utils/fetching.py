@@ -1,8 +1,8 @@
 # Import libraries
 import os
-import pickle
 import json
 
+import joblib
 import numpy as np
 import pandas as pd
 
@@ -21,7 +21,7 @@ def fetch_nv(out_folder='../../Data', nv_filepath='../../cache',
     :param out_folder: str
         Path where the data is downloaded.
     :param nv_filepath: str
-        Pickle file where the full data is saved
+        Folder of the joblib file where the full data is saved
         (for faster loading than the fetch_neurovault).
     :param download: bool, default=False
         If True: the data is downloaded from the web-API.
@@ -54,16 +54,14 @@ def fetch_nv(out_folder='../../Data', nv_filepath='../../cache',
                                       verbose = 2,
                                       collection_id = 4337)
         
-        # Save the output
-        with open(nv_file, 'wb') as f:
-            pickle.dump(neurovault, f)
+        # Save the output (joblib.load also reads files written with pickle)
+        joblib.dump(neurovault, nv_file, compress=3)
 
     else:
         print("Load pre-fetched data from Neurovault...")
 
         # Load the file
-        with open(nv_file, 'rb') as f:
-            neurovault = pickle.load(f)
+        neurovault = joblib.load(nv_file)
 
     n_fmri_dl = len(neurovault.images)
     print(f"Number of (down)loaded fMRI files: {n_fmri_dl}")
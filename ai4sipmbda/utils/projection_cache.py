@@ -0,0 +1,76 @@
+# Import libraries
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+
+def hash_arrays(*arrays):
+    """
+    Computes a digest of the content of numpy arrays.
+    :param arrays: np.ndarray
+        Arrays to hash, e.g. the DiFuMo mask and pseudo-inverse projector.
+    Output:
+    :param digest: str
+        Hexadecimal digest, changing whenever any of the arrays changes.
+    """
+
+    h = hashlib.blake2b(digest_size=16)
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        h.update(f"{array.dtype.str}:{array.shape}".encode())
+        h.update(array.data)
+    return h.hexdigest()
+
+
+def cache_key(path, projector_hash):
+    """
+    Creates the cache key of the projection of an image.
+    :param path: str
+        Path of the image file.
+    :param projector_hash: str
+        Digest of the projector, as returned by hash_arrays.
+    Output:
+    :param key: str
+        Key changing whenever the image file is modified or the projector
+        changes.
+    """
+
+    mtime = os.stat(path).st_mtime_ns
+    key = f"{os.path.abspath(path)}:{mtime}:{projector_hash}".encode()
+    return hashlib.blake2b(key, digest_size=8).hexdigest()
+
+
+def load_or_project(path, cache_dir, projector_hash, project):
+    """
+    Loads the projection of an image from the cache, computing and storing it
+    if it is not there yet.
+    :param path: str
+        Path of the image file.
+    :param cache_dir: str
+        Folder where projections are stored, one .npy file per image.
+    :param projector_hash: str
+        Digest of the projector, as returned by hash_arrays.
+    :param project: callable
+        Function of the image path returning its projection.
+    Output:
+    :param projection: np.ndarray
+        The projection of the image.
+    """
+
+    cache_file = os.path.join(cache_dir, cache_key(path, projector_hash) + ".npy")
+    if os.path.exists(cache_file):
+        return np.load(cache_file)
+
+    projection = project(path)
+
+    # Write to a temporary file first so that concurrent workers never read
+    # a partially written projection
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        np.save(f, projection)
+    os.replace(tmp_file, cache_file)
+
+    return projection
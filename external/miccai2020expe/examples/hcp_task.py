@@ -15,6 +15,10 @@ studies = [
     ("hcp", 100),
 ]
 
+A = np.load(
+    "/data/parietal/store2/work/btajini/ts_1024_10sub_task/data_generation_task/data_generation/estimated_mix_mat_900_new.npy"
+)
+
 for study, train_size in studies:
     path = (
         "/data/parietal/store2/work/btajini/ts_1024_10sub_task/studies_difumo_1024_testonly/data_%s_smooth_8.pt"
@@ -27,9 +31,6 @@ for study, train_size in studies:
     else:
         X_t, Y_t = load(path)
     m = len(X_t)
-    A = np.load(
-        "/data/parietal/store2/work/btajini/ts_1024_10sub_task/data_generation_task/data_generation/estimated_mix_mat_900_new.npy"
-    )
     f = lambda X, Y: condica(A, X, Y, 200)
     do_classif(
         X_t,
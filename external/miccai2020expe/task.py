@@ -1,10 +1,14 @@
+import os
+
 from joblib.parallel import Parallel, delayed
-from sklearn.base import BaseEstimator, ClassifierMixin
+from sklearn.base import BaseEstimator, ClassifierMixin, clone
 import numpy as np
 import pandas as pd
+from scipy import linalg
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.model_selection import ShuffleSplit
+from sklearn.utils.validation import check_array, check_X_y
 
 from task_loading import preprocess_label
 
@@ -42,15 +46,126 @@ class AugmentedClassifier(BaseEstimator, ClassifierMixin):
         return self.model.score(X, y)
 
 
+def _class_moments(X, y, n_classes):
+    """
+    Computes per-class sufficient statistics of the data
+    Parameters
+    ----------
+    X: np array of shape (n_samples, n_features)
+        Input data
+    y: np array of shape (n_samples,)
+        Class numbers, between 0 and n_classes - 1
+    n_classes: int
+        Number of classes
+    Returns
+    -------
+    counts: np array of shape (n_classes,)
+        number of samples per class
+    sums: np array of shape (n_classes, n_features)
+        sum of the samples of each class
+    grams: np array of shape (n_classes, n_features, n_features)
+        Gram matrix X_k.T X_k of the samples of each class
+    """
+    n_features = X.shape[1]
+    counts = np.bincount(y, minlength=n_classes)
+    sums = np.zeros((n_classes, n_features))
+    grams = np.zeros((n_classes, n_features, n_features))
+    for k in np.flatnonzero(counts):
+        X_k = np.asarray(X[y == k], dtype=np.float64)
+        sums[k] = X_k.sum(axis=0)
+        grams[k] = X_k.T.dot(X_k)
+    return counts, sums, grams
+
+
+class MomentLDA(BaseEstimator, ClassifierMixin):
+    """
+    Linear discriminant analysis with class covariances shrunk by the
+    Oracle Approximating Shrinkage estimator. Gives the same classifier as
+    LinearDiscriminantAnalysis(solver="lsqr", covariance_estimator=OAS()),
+    but it can also be fitted from per-class moments (see _class_moments):
+    moments of overlapping training sets are then derived from the moments
+    of the whole data set without going through the samples again.
+    """
+
+    def fit(self, X, y):
+        X, y = check_X_y(X, y)
+        classes, y = np.unique(y, return_inverse=True)
+        self.fit_moments(*_class_moments(X, y, len(classes)))
+        self.classes_ = classes[self.classes_]
+        return self
+
+    def fit_moments(self, counts, sums, grams):
+        """
+        Fits the model from per-class moments, as returned by
+        _class_moments. Classes are the indices of the non-empty classes.
+        """
+        self.classes_ = np.flatnonzero(counts)
+        counts = counts[self.classes_]
+        sums = sums[self.classes_]
+        grams = grams[self.classes_]
+        n_features = sums.shape[1]
+
+        self.priors_ = counts / counts.sum()
+        self.means_ = sums / counts[:, None]
+        self.covariance_ = np.zeros((n_features, n_features))
+        for n_k, prior, mean, gram in zip(
+            counts, self.priors_, self.means_, grams
+        ):
+            emp_cov = gram / n_k - np.outer(mean, mean)
+            # shrinkage towards a scaled identity, as in sklearn's OAS
+            alpha = np.mean(emp_cov ** 2)
+            mu = np.trace(emp_cov) / n_features
+            num = alpha + mu ** 2
+            den = (n_k + 1) * (alpha - mu ** 2 / n_features)
+            shrinkage = 1.0 if den == 0 else min(num / den, 1.0)
+            emp_cov *= 1.0 - shrinkage
+            emp_cov.flat[:: n_features + 1] += shrinkage * mu
+            self.covariance_ += prior * emp_cov
+
+        self.coef_ = linalg.lstsq(self.covariance_, self.means_.T)[0].T
+        self.intercept_ = -0.5 * np.sum(
+            self.means_ * self.coef_, axis=1
+        ) + np.log(self.priors_)
+        return self
+
+    def decision_function(self, X):
+        X = check_array(X)
+        return np.dot(X, self.coef_.T) + self.intercept_
+
+    def predict(self, X):
+        return self.classes_[np.argmax(self.decision_function(X), axis=1)]
+
+
+def _with_final_fold(splits):
+    """
+    Yields the given (train, test) splits followed by None, standing for a
+    fold using all samples for training, so that the final model is fitted
+    concurrently with the cross-validation folds.
+    """
+    yield from splits
+    yield None
+
+
 def do_classif(
-    X, Y, f, method_name, filename, train_size, n_splits=5, n_jobs=5
+    X,
+    Y,
+    f,
+    method_name,
+    filename,
+    train_size,
+    n_splits=5,
+    n_jobs=5,
+    final_fit=False,
+    rf_oob=False,
+    moment_lda=False,
 ):
     """
     Tries 4 different classifier with the given augmentation method
     Parameters
     ----------
-    X: np array of shape (n_samples, n_features)
-        Input data
+    X: np array of shape (n_samples, n_features) or path-like
+        Input data, or path to a .npy file holding it. Files are memory
+        mapped so that only the rows used by each split are read.
     Y: np array of shape (n_samples,)
         Labels
     f: function of X, Y
@@ -58,7 +173,8 @@ def do_classif(
     method_name: str
         the name of the method used to produce fake data
     filename: str
-        filename is the path result file
+        filename is the path result file. It is written as parquet
+        (requires pyarrow) if it ends with .parquet, as csv otherwise.
     train_size : float or int, default=None
         If float, should be between 0.0 and 1.0 and represent the
         proportion of the dataset to include in the train split. If
@@ -66,8 +182,31 @@ def do_classif(
         the value is automatically set to the complement of the test size.
     n_splits : int, default=10
         Number of re-shuffling & splitting iterations.
-    n_jobs: int, default: None
-        The maximum number of concurrently running jobs,
+    n_jobs: int, default=5
+        The maximum number of splits fitted concurrently, all models
+        included. Models are kept single-threaded to avoid
+        oversubscription.
+    final_fit: bool, default=False
+        If True, each model is also fitted on all subjects, alongside the
+        splits.
+    rf_oob: bool, default=False
+        If True, the random forest is fitted once on all samples with
+        n_jobs trees built concurrently, and scored on its out-of-bag
+        samples instead of the held-out subjects of each split. This is
+        much faster, but out-of-bag samples are not subject-wise held out
+        and, with augmentation, include fake samples.
+    moment_lda: bool, default=False
+        If True and f is None, LDA is replaced by MomentLDA, whose folds
+        are derived from per-class moments computed once over all samples.
+        MomentLDA uses OAS shrinkage on unstandardized class covariances
+        instead of the Ledoit-Wolf shrinkage of standardized classes used
+        by LinearDiscriminantAnalysis(shrinkage="auto"), so its scores are
+        not comparable with the default LDA.
+
+    Returns
+    -------
+    final_models: dict (only returned if final_fit is True)
+        dictionary algo name -> classifier fitted on all subjects
     """
 
     models = []
@@ -85,10 +224,16 @@ def do_classif(
         "max_iter": 20000,
     }
 
-    models.append(
-        (LinearDiscriminantAnalysis(solver="lsqr", shrinkage="auto"), "LDA")
-    )
-    models.append((RandomForestClassifier(verbose=True), "RF"))
+    if moment_lda and f is None:
+        models.append((MomentLDA(), "LDA"))
+    else:
+        models.append(
+            (
+                LinearDiscriminantAnalysis(solver="lsqr", shrinkage="auto"),
+                "LDA",
+            )
+        )
+    models.append((RandomForestClassifier(n_jobs=1, verbose=True), "RF"))
     # models.append((MLPClassifier(verbose=True, **params_2L), "MLP"))
     # models.append(
     #     (
@@ -109,34 +254,122 @@ def do_classif(
     #     )
     # )
 
-    def do_split(split, X, Y, f, model, subjects):
+    def do_split(split, X, Y_all, f, model, subjects, groups, moments):
+        # trees are built on float32 features, cast before sklearn copies.
+        # With augmentation, f gets the original precision and the stacked
+        # data is converted by sklearn
+        dtype = None
+        if f is None and isinstance(model, RandomForestClassifier):
+            dtype = np.float32
+        clf = AugmentedClassifier(clone(model), f)
+
+        if split is None:
+            # final model, fitted on all samples and not scored
+            if moments is None:
+                clf.fit(np.asarray(X, dtype=dtype), Y_all)
+            else:
+                clf.model.fit_moments(*moments)
+            return None, clf
+
         train, test = split
-        train, test = subjects[train], subjects[test]
-        train = Y["subject"].isin(train)
-        test = Y["subject"].isin(test)
-        Y_train, dict = preprocess_label(Y[train], return_dict=True)
-        Y_test = preprocess_label(Y[test], use_dict=dict)
-        X_train = X[train]
-        X_test = X[test]
-        clf = AugmentedClassifier(model, f)
-        clf.fit(X_train, Y_train)
+        train = np.sort(np.concatenate([groups[s] for s in subjects[train]]))
+        test = np.sort(np.concatenate([groups[s] for s in subjects[test]]))
+        Y_train = Y_all[train]
+        Y_test = Y_all[test]
+        X_test = np.ascontiguousarray(X[test], dtype=dtype)
+        # training rows are only read when the fold is not derived from the
+        # moments of all samples
+        if moments is None:
+            clf.fit(np.asarray(X[train], dtype=dtype), Y_train)
+        elif len(train) <= len(test):
+            clf.model.fit_moments(
+                *_class_moments(X[train], Y_train, len(moments[0]))
+            )
+        else:
+            # remove the contribution of the held-out subjects
+            test_moments = _class_moments(X_test, Y_test, len(moments[0]))
+            clf.model.fit_moments(
+                *[m - m_test for m, m_test in zip(moments, test_moments)]
+            )
         score_split = clf.score(X_test, Y_test)
-        return score_split
+        return score_split, clf
 
-    scores = []
+    if isinstance(X, (str, os.PathLike)):
+        X = np.load(X, mmap_mode="r", allow_pickle=False)
+
+    subjects = Y["subject"].unique()
+    # positions of the rows of each subject
+    groups = Y.groupby("subject").indices
+    # labels are encoded once, all splits share the same class numbers
+    Y_all = preprocess_label(Y)
+
+    # the splits of all models are dispatched together, so that models
+    # with different bottlenecks run concurrently
+    tasks = []
     for model, name in models:
-        subjects = Y["subject"].unique()
+        if rf_oob and isinstance(model, RandomForestClassifier):
+            continue
+        moments = None
+        if f is None and isinstance(model, MomentLDA):
+            # without augmentation, the training sets of all splits are
+            # made of the same samples: compute their moments only once
+            moments = _class_moments(X, Y_all, Y_all.max() + 1)
+            # fail on bad data like LinearDiscriminantAnalysis does
+            if not all(np.all(np.isfinite(m)) for m in moments):
+                raise ValueError("Input X contains NaN or infinity.")
         sf = ShuffleSplit(
             n_splits=n_splits, train_size=train_size, random_state=0
         )
-        scores_split = Parallel(verbose=True, n_jobs=n_jobs)(
-            delayed(do_split)(split, X, Y, f, model, subjects)
-            for split in sf.split(range(len(subjects)))
-        )
-        for i_split, score_split in enumerate(scores_split):
+        splits = sf.split(range(len(subjects)))
+        if final_fit:
+            splits = _with_final_fold(splits)
+        for split in splits:
+            tasks.append(
+                (
+                    name,
+                    delayed(do_split)(
+                        split, X, Y_all, f, model, subjects, groups, moments
+                    ),
+                )
+            )
+    results = Parallel(n_jobs=n_jobs, backend="loky", verbose=10)(
+        task for _, task in tasks
+    )
+    scores_split = {name: [] for _, name in models}
+    for (name, _), result in zip(tasks, results):
+        scores_split[name].append(result)
+
+    scores = []
+    final_models = {}
+    for model, name in models:
+        if rf_oob and isinstance(model, RandomForestClassifier):
+            clf = AugmentedClassifier(
+                clone(model).set_params(
+                    n_jobs=n_jobs, oob_score=True, n_estimators=500
+                ),
+                f,
+            )
+            dtype = np.float32 if f is None else None
+            clf.fit(np.asarray(X, dtype=dtype), Y_all)
+            scores.append((method_name, name, clf.model.oob_score_, 0))
+            if final_fit:
+                final_models[name] = clf
+            continue
+
+        if final_fit:
+            _, final_models[name] = scores_split[name].pop()
+        for i_split, (score_split, _) in enumerate(scores_split[name]):
             scores.append((method_name, name, score_split, i_split))
 
     scores = pd.DataFrame(
         scores, columns=["method_name", "algo", "score", "split"]
     )
-    scores.to_csv(filename)
+    if str(filename).endswith(".parquet"):
+        # method and algo names are stored dictionary-encoded
+        scores = scores.astype({"method_name": "category", "algo": "category"})
+        scores.to_parquet(filename)
+    else:
+        scores.to_csv(filename)
+
+    if final_fit:
+        return final_models
@@ -106,7 +106,14 @@ def preprocess_label(Y_t, use_dict=None, return_dict=False):
     else:
         Y_dict = use_dict
 
+    Y = Y_t["contrast"].map(Y_dict)
+    if Y.isna().any():
+        raise KeyError(
+            "Unknown labels: %s" % list(Y_t["contrast"][Y.isna()].unique())
+        )
+    Y = Y.to_numpy(dtype=int)
+
     if return_dict:
-        return Y_t["contrast"].apply(lambda x: Y_dict[x]).values, Y_dict
+        return Y, Y_dict
     else:
-        return Y_t["contrast"].apply(lambda x: Y_dict[x]).values
+        return Y
@@ -1,6 +1,7 @@
-from miccai2020expe.task import AugmentedClassifier
+from miccai2020expe.task import AugmentedClassifier, do_classif
 from condica.main import condica
 import numpy as np
+import pandas as pd
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
 
 X = np.random.rand(100, 10)
@@ -13,3 +14,51 @@ def test_shapes():
     f = lambda X, Y: condica(A, X, Y, 10, n_quantiles=10)
     clf = AugmentedClassifier(lda, f)
     clf.fit(X, Y)
+
+
+def test_moment_lda():
+    from miccai2020expe.task import MomentLDA, _class_moments
+    from sklearn.covariance import OAS
+
+    lda = LinearDiscriminantAnalysis(solver="lsqr", covariance_estimator=OAS())
+    lda.fit(X, Y)
+    mlda = MomentLDA().fit(X, Y)
+    np.testing.assert_array_equal(mlda.predict(X), lda.predict(X))
+    np.testing.assert_allclose(mlda.covariance_, lda.covariance_)
+
+    # moments of a subset, obtained by removing the held-out samples
+    train, test = np.arange(80), np.arange(80, 100)
+    moments = _class_moments(X, Y, 4)
+    test_moments = _class_moments(X[test], Y[test], 4)
+    mlda_sub = MomentLDA().fit_moments(
+        *[m - m_test for m, m_test in zip(moments, test_moments)]
+    )
+    mlda_train = MomentLDA().fit(X[train], Y[train])
+    np.testing.assert_allclose(mlda_sub.coef_, mlda_train.coef_)
+    np.testing.assert_allclose(mlda_sub.intercept_, mlda_train.intercept_)
+
+
+def test_do_classif(tmp_path):
+    labels = pd.DataFrame(
+        {
+            "subject": np.repeat(np.arange(10), 3),
+            "contrast": np.tile(["a", "b", "c"], 10),
+        }
+    )
+    X_t = np.random.rand(30, 10)
+    filename = tmp_path / "scores.csv"
+    final_models = do_classif(
+        X_t,
+        labels,
+        None,
+        method_name="Original",
+        filename=filename,
+        train_size=6,
+        n_splits=2,
+        n_jobs=1,
+        final_fit=True,
+        rf_oob=True,
+    )
+    scores = pd.read_csv(filename)
+    assert scores.groupby("algo").size().to_dict() == {"LDA": 2, "RF": 1}
+    assert set(final_models) == {"LDA", "RF"}